@@ -1,14 +1,20 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import requests
+import requests.adapters
 import sqlite3
 import streamlit as st
 import urllib.parse
-from io import StringIO, BytesIO
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
 import hashlib
-import folium
-import json
-from geopy.geocoders import Nominatim
-from streamlit_folium import st_folium
+import hmac
+import os
+import time
+import orjson
 
 # ----------------- DATABASE & FILE PATH SETUP -----------------
 DB_FILE = "vaccination_data.db"
@@ -23,25 +29,134 @@ DATASET_URL_1 = f"https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=
 file_id_3 = "1gnux_uKipCE4f-hiThO7c_WHF8kx8nh8"
 GEOJSON_URL = f"https://drive.google.com/uc?id={file_id_3}"
 
+census_url = "https://drive.google.com/uc?id=1Fswh6Eq_wrsf5FbpaaUve9K0KOZ6q3zg"
+
+# ----------------- LOCAL CACHE -----------------
+CACHE_DIR = "cache"
+GEOJSON_CACHE_FILE = os.path.join(CACHE_DIR, "boundaries.geojson")
+
+# ----------------- REMOTE DATA LOADERS -----------------
+HTTP_TIMEOUT = 30  # seconds; a stalled Google download fails instead of hanging the script run
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 8  # covers the GeoJSON prefetch thread alongside the CSV stream
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    # Shared keep-alive session so repeat Google requests skip the TCP/TLS handshake
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_geolocator():
+    # One Nominatim client with its own pooled requests session, reused across geocode lookups
+    from functools import partial
+    from geopy.adapters import RequestsAdapter
+    from geopy.geocoders import Nominatim
+
+    return Nominatim(user_agent="streamlit_map", timeout=HTTP_TIMEOUT,
+                     adapter_factory=partial(RequestsAdapter, pool_connections=HTTP_POOL_CONNECTIONS,
+                                             pool_maxsize=HTTP_POOL_MAXSIZE))
+
+def load_geojson(url, session=None):
+    # Downloaded once, then served from the local copy on later runs.
+    # Only read when city_boundaries is (re)built, so the parsed tree is not kept in memory.
+    if os.path.exists(GEOJSON_CACHE_FILE):
+        with open(GEOJSON_CACHE_FILE, "rb") as f:
+            content = f.read()
+    else:
+        response = (session or get_http_session()).get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        content = response.content
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = GEOJSON_CACHE_FILE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, GEOJSON_CACHE_FILE)
+    # Parse the raw bytes; response.text would first decode (and charset-sniff) the whole body
+    return orjson.loads(content)
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def fetch_content(url):
+    response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+def geocode(city, state):
+    # Normalize first so "Boston"/"boston " share one cache entry
+    return _geocode(normalize_city(city), normalize_city(state))
+
+@st.cache_data(show_spinner=False, ttl=30 * 24 * 3600)
+def _geocode(city_key, state_key):
+    # Memory (st.cache_data) -> SQLite geocode_cache -> Nominatim
+    key = f"{city_key}, {state_key}"
+    row = get_conn(DB_FILE).execute("SELECT lat, lon FROM geocode_cache WHERE key = ?", (key,)).fetchone()
+    if row:
+        return row[0], row[1]
+    location = get_geolocator().geocode(f"{key}, USA")
+    if not location:
+        return None
+    with write_transaction(DB_FILE) as conn:
+        conn.execute("INSERT OR REPLACE INTO geocode_cache (key, lat, lon, ts) VALUES (?, ?, ?, ?)",
+                     (key, location.latitude, location.longitude, int(time.time())))
+    return location.latitude, location.longitude
+
 # ----------------- DATABASE FUNCTIONS -----------------
-def create_connection(db_path):
-    return sqlite3.connect(db_path)
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=5000;
+PRAGMA cache_size=-20000;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+"""
+SQLITE_MAX_VARIABLES = 999  # lowest compiled-in default across SQLite versions
+CSV_BLOCK_BYTES = 16 << 20
+# Pinned so a column that is blank or all-integer in the first block can't fail to convert in a later one;
+# any other columns are still inferred
+CSV_TEXT_COLUMNS = ("STATE", "CITY", "AGE_GROUP", "GENDER", "ETHNICITY", "DESCRIPTION", "RACE")
+
+def csv_convert_options():
+    column_types = {column: pa.string() for column in CSV_TEXT_COLUMNS}
+    column_types.update(VACCINATED=pa.bool_(), YEAR=pa.int64())
+    # Blank cells become NULL, as with pd.read_csv, so the IS NOT NULL filters keep excluding them
+    return pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+
+def _apply_pragmas(conn):
+    conn.executescript(SQLITE_PRAGMAS)
 
-def setup_user_database():
-    conn = create_connection(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+def create_connection(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    _apply_pragmas(conn)
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def get_conn(db_path):
+    # One long-lived connection per database file for the whole process, shared by every session.
+    # Reads use it directly; writes go through write_transaction().
+    return create_connection(db_path)
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock(db_path):
+    return threading.Lock()
+
+@contextmanager
+def write_transaction(db_path):
+    # The shared connection holds a single transaction, so without the lock one session's
+    # rollback would also undo another session's uncommitted writes
+    conn = get_conn(db_path)
+    with get_write_lock(db_path), conn:
+        yield conn
+
+USERS_DDL = '''CREATE TABLE IF NOT EXISTS users (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         username TEXT UNIQUE,
                         password TEXT
-                      )''')
-    conn.commit()
-    conn.close()
+                      );'''
 
-def setup_vaccination_database():
-    conn = create_connection(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS vaccination_data (
+VACCINATION_DDL = '''CREATE TABLE IF NOT EXISTS vaccination_data (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         STATE TEXT,
                         CITY TEXT,
@@ -50,59 +165,375 @@ def setup_vaccination_database():
                         ETHNICITY TEXT,
                         VACCINATED BOOLEAN,
                         Year INTEGER,
-                        DESCRIPTION TEXT
-                      )''')
-    conn.commit()
-    conn.close()
+                        DESCRIPTION TEXT,
+                        RACE TEXT
+                      );'''
+
+VACCINATION_STAGING_TABLE = "vaccination_data_new"
+
+VACCINATION_INDEXES_SQL = '''
+DROP INDEX IF EXISTS idx_state_city;
+CREATE INDEX IF NOT EXISTS idx_state_city_desc ON vaccination_data(STATE, CITY, DESCRIPTION);
+CREATE INDEX IF NOT EXISTS idx_desc ON vaccination_data(DESCRIPTION);
+'''
+
+# Stored in PRAGMA user_version; bump it when the stored boundary format changes
+# (1: simplified, rounded features; 2: features without a CITY are skipped)
+BOUNDARIES_VERSION = 2
+
+BOUNDARIES_DDL = '''CREATE TABLE IF NOT EXISTS city_boundaries (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        CITY TEXT,
+                        CITY_KEY TEXT,
+                        FEATURE TEXT
+                      );
+CREATE INDEX IF NOT EXISTS idx_boundaries_city_key ON city_boundaries(CITY_KEY);
+'''
+
+RACE_MAPPING = {
+    "Hispanic or Latino": "Hispanic",
+    "Not Hispanic or Latino": "White",
+    "African American": "Black",
+    "Asian": "Asian",
+    "Native American": "Native American",
+    "Pacific Islander": "Pacific Islander",
+    "Other": "Other"
+}
+
+GEOCODE_CACHE_DDL = '''CREATE TABLE IF NOT EXISTS geocode_cache (
+                        key TEXT PRIMARY KEY,
+                        lat REAL,
+                        lon REAL,
+                        ts INTEGER
+                      );
+'''
+
+def setup_user_database():
+    get_conn(USER_DB).executescript(USERS_DDL)
+
+def setup_vaccination_database():
+    conn = get_conn(DB_FILE)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(city_boundaries)")]
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if columns and ("CITY_KEY" not in columns or version < BOUNDARIES_VERSION):
+        # Boundaries are derived from the GeoJSON, drop the old layout and re-ingest on the next map render
+        conn.execute("DROP TABLE city_boundaries")
+    conn.executescript(VACCINATION_DDL + VACCINATION_INDEXES_SQL + BOUNDARIES_DDL + GEOCODE_CACHE_DDL)
+    conn.execute(f"PRAGMA user_version={BOUNDARIES_VERSION}")
+    with write_transaction(DB_FILE):
+        populate_race_column(conn)
+
+def populate_race_column(conn):
+    # Backfills RACE for databases loaded before it was computed at ingest time. Loads since then
+    # always write it, so the full-table UPDATE only runs when the column is first added.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(vaccination_data)")]
+    if "RACE" in columns:
+        return
+    conn.execute("ALTER TABLE vaccination_data ADD COLUMN RACE TEXT")
+    cases = " ".join("WHEN ? THEN ?" for _ in RACE_MAPPING)
+    params = [value for pair in RACE_MAPPING.items() for value in pair]
+    conn.execute(f"UPDATE vaccination_data SET RACE = CASE ETHNICITY {cases} ELSE 'Unknown' END", params)
+
+def normalize_city(name):
+    return (name or "").strip().lower()
 
 def is_data_present():
-    conn = create_connection(DB_FILE)
-    cursor = conn.cursor()
+    cursor = get_conn(DB_FILE).cursor()
     cursor.execute("SELECT COUNT(*) FROM vaccination_data")
     count = cursor.fetchone()[0]
-    conn.close()
     return count > 0
 
+def swap_in_staged_data(conn):
+    # One transaction: readers see either the old (empty) table or the complete new one.
+    # executescript runs the statements verbatim, so the explicit BEGIN/COMMIT are what bind them.
+    try:
+        conn.executescript(f"""
+            BEGIN;
+            DROP TABLE IF EXISTS vaccination_data;
+            ALTER TABLE {VACCINATION_STAGING_TABLE} RENAME TO vaccination_data;
+            {VACCINATION_INDEXES_SQL}
+            COMMIT;
+        """)
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
 def load_data_into_db():
     if not is_data_present():
+        conn = get_conn(DB_FILE)
         try:
-            df = pd.read_csv(DATASET_URL_1)
-            conn = create_connection(DB_FILE)
-            df.to_sql("vaccination_data", conn, if_exists="replace", index=False)
-            conn.close()
+            # Stays at synchronous=NORMAL: in WAL mode OFF also skips the checkpoint syncs, so a power
+            # loss mid-load could corrupt the whole file, geocode_cache and city_boundaries included.
+            # to_sql commits per call, so blocks go into a staging table that only replaces
+            # vaccination_data once every block is in
+            conn.execute(f"DROP TABLE IF EXISTS {VACCINATION_STAGING_TABLE}")
+            # Stream the sheet through Arrow's C++ CSV reader and insert it block by block,
+            # so memory stays bounded by CSV_BLOCK_BYTES
+            with get_http_session().get(DATASET_URL_1, stream=True, timeout=HTTP_TIMEOUT) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                reader = pacsv.open_csv(response.raw, read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_BYTES),
+                                        convert_options=csv_convert_options())
+                for i, batch in enumerate(reader):
+                    chunk = batch.to_pandas()
+                    if "RACE" not in chunk.columns:
+                        chunk["RACE"] = chunk["ETHNICITY"].map(RACE_MAPPING).fillna("Unknown")
+                    # Multi-row INSERTs sized to stay under SQLite's bound-parameter limit
+                    chunk.to_sql(VACCINATION_STAGING_TABLE, conn, if_exists="replace" if i == 0 else "append",
+                                 index=False, method="multi",
+                                 chunksize=max(1, SQLITE_MAX_VARIABLES // len(chunk.columns)))
+            swap_in_staged_data(conn)
+            # Index statistics let the planner answer SELECT DISTINCT with a skip-scan
+            conn.execute("ANALYZE vaccination_data")
         except Exception as e:
+            # Nothing partial is left behind, so the next run retries the whole load
+            conn.execute(f"DROP TABLE IF EXISTS {VACCINATION_STAGING_TABLE}")
             st.error(f"❌ Error loading dataset into DB: {e}")
+            return False
+    return True
+
+BOUNDARY_SIMPLIFY_TOLERANCE = 0.0001  # degrees, roughly 10m
+BOUNDARY_PRECISION = 5
+
+def boundaries_present():
+    return get_conn(DB_FILE).execute("SELECT 1 FROM city_boundaries LIMIT 1").fetchone() is not None
+
+def _round_coordinates(value):
+    if isinstance(value, float):
+        return round(value, BOUNDARY_PRECISION)
+    if isinstance(value, (list, tuple)):
+        return [_round_coordinates(item) for item in value]
+    return value
+
+def _round_geometry(geometry):
+    # GeometryCollections carry nested "geometries" instead of "coordinates"
+    geometry = dict(geometry)
+    if "coordinates" in geometry:
+        geometry["coordinates"] = _round_coordinates(geometry["coordinates"])
+    if "geometries" in geometry:
+        geometry["geometries"] = [_round_geometry(part) for part in geometry["geometries"]]
+    return geometry
+
+def simplify_feature(feature):
+    # Fewer vertices and 5 decimals (~1m) means far less JSON for Folium/Leaflet to ship and draw
+    from shapely.geometry import mapping, shape
+
+    if not feature.get("geometry"):
+        return feature
+    geometry = shape(feature["geometry"]).simplify(BOUNDARY_SIMPLIFY_TOLERANCE, preserve_topology=True)
+    return {**feature, "geometry": _round_geometry(mapping(geometry))}
+
+def load_boundaries_into_db(geojson_data=None):
+    if boundaries_present():
+        return
+    if geojson_data is None:
+        geojson_data = load_geojson(GEOJSON_URL)
+    rows = []
+    for feature in geojson_data["features"]:
+        feature = simplify_feature(feature)
+        name = feature["properties"].get("CITY") or ""
+        city_key = normalize_city(name)
+        if not city_key:
+            continue  # unnamed features would otherwise match an empty city selection
+        rows.append((name, city_key, orjson.dumps(feature).decode()))
+    with write_transaction(DB_FILE) as conn:
+        # Re-checked under the write lock: another session may have finished the same ingest meanwhile
+        if boundaries_present():
+            return
+        conn.executemany("INSERT INTO city_boundaries (CITY, CITY_KEY, FEATURE) VALUES (?, ?, ?)", rows)
+
+@st.cache_resource(show_spinner=False)
+def initialize_databases():
+    # Runs once per process instead of on every rerun
+    setup_user_database()
+    setup_vaccination_database()
+    # The GeoJSON download is independent of the dataset, so fetch it while the CSV streams in.
+    # Inserts stay on this thread since both go through the one shared connection.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        geojson_future = None
+        if not boundaries_present():
+            geojson_future = executor.submit(load_geojson, GEOJSON_URL, get_http_session())
+        loaded = load_data_into_db()
+        if geojson_future is not None:
+            try:
+                load_boundaries_into_db(geojson_future.result())
+            except Exception:
+                pass  # retried, with the error shown, when the map first renders
+    return loaded
+
+# ----------------- DASHBOARD QUERIES -----------------
+# Query results are served from memory across reruns; the TTL picks up a (re)loaded dataset
+DB_CACHE_TTL = 600
+CATEGORY_COLUMNS = ("STATE", "CITY", "ETHNICITY", "GENDER", "AGE_GROUP", "DESCRIPTION", "RACE")
+
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL)
+def state_city_map():
+    # One index-only scan builds every sidebar option; reruns are dict lookups
+    rows = get_conn(DB_FILE).execute("SELECT DISTINCT STATE, CITY FROM vaccination_data "
+                                     "WHERE STATE IS NOT NULL AND CITY IS NOT NULL ORDER BY STATE, CITY").fetchall()
+    cities = {}
+    for state, city in rows:
+        cities.setdefault(state, []).append(city)
+    return cities
+
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL)
+def list_vaccines():
+    rows = get_conn(DB_FILE).execute("SELECT DISTINCT DESCRIPTION FROM vaccination_data "
+                                     "WHERE DESCRIPTION IS NOT NULL ORDER BY DESCRIPTION").fetchall()
+    return [row[0] for row in rows]
+
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL)
+def load_preview(limit=5):
+    return pd.read_sql("SELECT * FROM vaccination_data LIMIT ?", get_conn(DB_FILE), params=(limit,),
+                       dtype_backend="pyarrow")
+
+def _filter_clause(state, city, vaccines):
+    clause = "STATE = ? AND CITY = ?"
+    params = [state, city]
+    if vaccines:
+        clause += " AND DESCRIPTION IN (%s)" % ",".join("?" * len(vaccines))
+        params.extend(vaccines)
+    return clause, params
+
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL, max_entries=64)
+def load_vax(state, city, vaccines):
+    clause, params = _filter_clause(state, city, vaccines)
+    # Arrow-backed columns instead of per-cell Python objects for the wide text columns
+    df = pd.read_sql(f"SELECT * FROM vaccination_data WHERE {clause}", get_conn(DB_FILE),
+                     params=params, dtype_backend="pyarrow")
+    # Low-cardinality text columns become integer-coded categoricals, done once inside the cache
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    if "VACCINATED" in df.columns:
+        df["VACCINATED"] = df["VACCINATED"].astype("int8[pyarrow]")
+    return df
+
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL, max_entries=64)
+def load_group_counts(columns, state, city, vaccines):
+    # Vaccinated / non-vaccinated counts per group in a single conditional-aggregation pass.
+    # columns are fixed column names from the dashboard, never user input.
+    clause, params = _filter_clause(state, city, vaccines)
+    group = ", ".join(columns)
+    not_null = "".join(f" AND {column} IS NOT NULL" for column in columns)
+    query = (f"SELECT {group}, "
+             "SUM(CASE WHEN VACCINATED = 1 THEN 1 ELSE 0 END) AS \"Vaccinated Count\", "
+             "SUM(CASE WHEN VACCINATED = 0 THEN 1 ELSE 0 END) AS \"Non-Vaccinated Count\" "
+             f"FROM vaccination_data WHERE {clause} AND VACCINATED IN (0, 1){not_null} "
+             f"GROUP BY {group} ORDER BY {group}")
+    return pd.read_sql(query, get_conn(DB_FILE), params=params)
+
+@st.cache_data(show_spinner=False)
+def load_city_shapes(city):
+    load_boundaries_into_db()
+    rows = get_conn(DB_FILE).execute("SELECT FEATURE FROM city_boundaries WHERE CITY_KEY = ?",
+                                     (normalize_city(city),)).fetchall()
+    return [orjson.loads(row[0]) for row in rows]
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def build_city_map(city, state):
+    # Built once per city/state, so reruns from unrelated widgets reuse the same map.
+    # Geo libraries are imported here to keep them off the login path.
+    import folium
+    from shapely.geometry import shape
+
+    # Indexed lookup of the city's geometry (GeoJSON is ingested into SQLite on first use)
+    city_shapes = load_city_shapes(city)
+    if not city_shapes:
+        return None
+
+    # Get lat/lon using Nominatim (cached per city/state)
+    location = geocode(city, state)
+    if location:
+        center = list(location)
+    else:
+        # Fallback: a point guaranteed to lie inside the city's own boundary
+        point = shape(city_shapes[0]["geometry"]).representative_point()
+        center = [point.y, point.x]
+
+    m = folium.Map(location=center, zoom_start=11)
+    # One Leaflet layer for every boundary of the city instead of one layer per feature
+    folium.GeoJson({"type": "FeatureCollection", "features": city_shapes}, style_function=lambda x: {
+        "fillOpacity": 0,
+        "color": "blue",
+        "weight": 3
+    }).add_to(m)
+    return m
+
+def status_counts(counts, column, count_column):
+    # One status's slice of a load_group_counts() result, as a small Plotly input
+    nonzero = counts[counts[count_column] > 0]
+    return nonzero[[column, count_column]].rename(columns={count_column: "count"})
+
+# ----------------- FORECASTING -----------------
+# The Synthea sheet is the dataset already in vaccination_data, so the forecast reads it from SQLite
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL)
+def load_yearly_vax():
+    return pd.read_sql("SELECT YEAR AS YEAR, COUNT(*) AS vaccinated_count FROM vaccination_data "
+                       "WHERE VACCINATED = 1 AND YEAR IS NOT NULL GROUP BY YEAR ORDER BY YEAR",
+                       get_conn(DB_FILE))
+
+@st.cache_data(show_spinner=False, ttl=DB_CACHE_TTL)
+def load_status_totals():
+    row = get_conn(DB_FILE).execute("SELECT SUM(VACCINATED = 1), SUM(VACCINATED = 0) FROM vaccination_data").fetchone()
+    return int(row[0] or 0), int(row[1] or 0)
+
+@st.cache_data(show_spinner=False)
+def arima_forecast(counts, steps, order=(1, 1, 1)):
+    # The fit is deterministic for the same series, so reruns reuse it instead of refitting
+    from statsmodels.tsa.arima.model import ARIMA
+
+    return np.asarray(ARIMA(list(counts), order=order).fit().forecast(steps=steps))
 
 # ----------------- USER AUTH -----------------
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# Fixed SQL strings so the shared connection's prepared-statement cache is hit on every call
+SELECT_PASSWORD_SQL = "SELECT password FROM users WHERE username = ?"
+INSERT_USER_SQL = "INSERT INTO users (username, password) VALUES (?, ?)"
+UPDATE_PASSWORD_SQL = "UPDATE users SET password = ? WHERE username = ?"
+
+def hash_password(password, salt=None):
+    # Stored as "<salt hex>:<scrypt hex>"
+    salt = salt or os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1, dklen=32)
+    return f"{salt.hex()}:{digest.hex()}"
+
+def verify_password(password, stored_password):
+    if ":" not in stored_password:
+        # Legacy unsalted SHA-256 hash
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored_password)
+    salt_hex = stored_password.split(":", 1)[0]
+    return hmac.compare_digest(hash_password(password, bytes.fromhex(salt_hex)), stored_password)
+
+@st.cache_resource(show_spinner=False)
+def dummy_password_hash():
+    # Verified against on the unknown-user path; the random password it hashes is never accepted
+    return hash_password(os.urandom(16).hex())
 
 def user_exists(username):
-    conn = create_connection(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    return get_conn(USER_DB).execute(SELECT_PASSWORD_SQL, (username,)).fetchone()
 
 def add_user(username, password):
-    conn = create_connection(USER_DB)
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hash_password(password)))
-        conn.commit()
-        conn.close()
+        with write_transaction(USER_DB) as conn:
+            conn.execute(INSERT_USER_SQL, (username, hash_password(password)))
         return True
     except sqlite3.IntegrityError:
         return False
 
 def authenticate_user(username, password):
-    conn = create_connection(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
-    stored_password = cursor.fetchone()
-    conn.close()
-    return stored_password and stored_password[0] == hash_password(password)
+    stored_password = get_conn(USER_DB).execute(SELECT_PASSWORD_SQL, (username,)).fetchone()
+    if stored_password is None:
+        # Unknown user: still run the KDF so response time doesn't reveal which usernames exist
+        verify_password(password, dummy_password_hash())
+        return False
+    if not verify_password(password, stored_password[0]):
+        return False
+    if ":" not in stored_password[0]:
+        # Upgrade legacy hashes to scrypt on the first successful login
+        with write_transaction(USER_DB) as conn:
+            conn.execute(UPDATE_PASSWORD_SQL, (hash_password(password), username))
+    return True
 
 # ----------------- LOGIN / SIGNUP -----------------
 def login_page():
@@ -142,9 +573,9 @@ def signup_page():
         st.rerun()
 
 # ----------------- APP STARTUP -----------------
-setup_user_database()
-setup_vaccination_database()
-load_data_into_db()
+if not initialize_databases():
+    # Let the next rerun retry the dataset load
+    initialize_databases.clear()
 
 if "authenticated" not in st.session_state:
     st.session_state["authenticated"] = False
@@ -159,79 +590,64 @@ if not st.session_state["authenticated"]:
     st.stop()
 
 # ----------------- DASHBOARD -----------------
+# Dashboard-only dependencies, imported after the login gate
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+from sklearn.metrics import mean_absolute_error, mean_squared_error
+
 st.title("📊 Vaccination Administration and Demand Forecasting")
 if st.sidebar.button("Logout"):
     st.session_state["authenticated"] = False
     st.rerun()
 
-# Load data from DB
-conn = create_connection(DB_FILE)
-df = pd.read_sql("SELECT * FROM vaccination_data", conn)
-conn.close()
-
 st.write("### 🔍 Raw Data Preview")
-st.dataframe(df.head())
+st.dataframe(load_preview())
 
 # Filters
 st.sidebar.header("🔍 Filter Data")
-state = st.sidebar.selectbox("📍 Select State", df["STATE"].dropna().unique())
-city = st.sidebar.selectbox("🏙 Select City", df[df["STATE"] == state]["CITY"].dropna().unique())
-vaccine = st.sidebar.multiselect("💉 Select Vaccine Type", df["DESCRIPTION"].dropna().unique())
+cities_by_state = state_city_map()
+state = st.sidebar.selectbox("📍 Select State", list(cities_by_state))
+city = st.sidebar.selectbox("🏙 Select City", cities_by_state.get(state, []))
+vaccine = st.sidebar.multiselect("💉 Select Vaccine Type", list_vaccines())
+# Sorted so the same selection hits the same cache entry regardless of pick order
+vaccine_key = tuple(sorted(vaccine))
 
-# Filtered data
-if vaccine:
-    filtered_df = df[(df["STATE"] == state) & (df["CITY"] == city) & (df["DESCRIPTION"].isin(vaccine))]
-else:
-    filtered_df = df[(df["STATE"] == state) & (df["CITY"] == city)]
+# Filtered data (filtering happens in SQLite, only matching rows are loaded)
+filtered_df = load_vax(state, city, vaccine_key)
 
 st.write(f"## 📈 Data for {city}, {state}")
 st.dataframe(filtered_df)
 
 # ----------------- MAP -----------------
-try:
-    # Load GeoJSON as plain JSON
-    response = requests.get(GEOJSON_URL)
-    geojson_data = json.loads(response.text)
-
-    # Try to find geometry for selected city
-    city_shapes = [feature for feature in geojson_data["features"]
-                   if feature["properties"].get("CITY", "").lower() == city.lower()]
-
-    if city_shapes:
-        # Get lat/lon using Nominatim
-        geolocator = Nominatim(user_agent="streamlit_map")
-        location = geolocator.geocode(f"{city}, {state}, USA")
-        if location:
-            center = [location.latitude, location.longitude]
-        else:
-            center = [37.0902, -95.7129]  # fallback: center of USA
-
-        m = folium.Map(location=center, zoom_start=11)
-        for shape in city_shapes:
-            folium.GeoJson(shape, style_function=lambda x: {
-                "fillOpacity": 0,
-                "color": "blue",
-                "weight": 3
-            }).add_to(m)
-
-        st.write(f"### 🗺 Map for {city}, {state}")
-        st_folium(m, width=800, height=500)
-    else:
-        st.warning(f"City '{city}' not found in GeoJSON.")
-
-except Exception as e:
-    st.error(f"Map rendering failed: {e}")
-
+@st.fragment
+def render_map(city, state):
+    # A fragment: interacting with the map reruns only this function, not the whole dashboard
+    if not city:
+        st.warning("No city selected, so there is no map to show.")
+        return
+    try:
+        from streamlit_folium import st_folium
 
+        m = build_city_map(city, state)
+        if m is not None:
+            st.write(f"### 🗺 Map for {city}, {state}")
+            # Nothing reads the map's state back, so don't send pan/zoom events to Python
+            st_folium(m, width=800, height=500, returned_objects=[])
+        else:
+            st.warning(f"City '{city}' not found in GeoJSON.")
 
+    except Exception as e:
+        st.error(f"Map rendering failed: {e}")
 
-
-import plotly.express as px
+render_map(city, state)
 
 # ----------------- VACCINATION COUNTS -----------------
 st.write("### 🧮 Total Vaccination Status")
-total_vaccinated = filtered_df[filtered_df["VACCINATED"] == 1].shape[0]
-total_non_vaccinated = filtered_df[filtered_df["VACCINATED"] == 0].shape[0]
+# Every row has a RACE (unmapped ethnicities become "Unknown"), so these groups add up to the totals
+race_summary = load_group_counts(("RACE",), state, city, vaccine_key)
+total_vaccinated = int(race_summary["Vaccinated Count"].sum())
+total_non_vaccinated = int(race_summary["Non-Vaccinated Count"].sum())
 total_count = total_vaccinated + total_non_vaccinated
 
 col1, col2, col3 = st.columns(3)
@@ -242,22 +658,24 @@ col3.metric("📊 Total Records", total_count)
 # ----------------- COMPARISON: VACCINATED VS NON -----------------
 st.write("### 📊 Vaccination Trends: Comparison Between Vaccinated & Non-Vaccinated")
 
-vaccinated_df = filtered_df[filtered_df["VACCINATED"] == 1].copy()
-non_vaccinated_df = filtered_df[filtered_df["VACCINATED"] == 0].copy()
+# Cached per-category counts from SQLite; each query feeds both the vaccinated and non-vaccinated chart
+ethnicity_counts = load_group_counts(("ETHNICITY",), state, city, vaccine_key)
+gender_counts = load_group_counts(("GENDER",), state, city, vaccine_key)
+age_group_counts = load_group_counts(("AGE_GROUP",), state, city, vaccine_key)
 
 # Pie Charts by Ethnicity
 col1, col2 = st.columns(2)
 with col1:
     st.write("#### ✅ Vaccinated - Ethnicity")
-    if not vaccinated_df.empty:
-        st.plotly_chart(px.pie(vaccinated_df, names="ETHNICITY", title="Vaccinated by Ethnicity"))
+    if total_vaccinated:
+        st.plotly_chart(px.pie(status_counts(ethnicity_counts, "ETHNICITY", "Vaccinated Count"), names="ETHNICITY", values="count", title="Vaccinated by Ethnicity"))
     else:
         st.info("No vaccinated data available.")
 
 with col2:
     st.write("#### ❌ Non-Vaccinated - Ethnicity")
-    if not non_vaccinated_df.empty:
-        st.plotly_chart(px.pie(non_vaccinated_df, names="ETHNICITY", title="Non-Vaccinated by Ethnicity"))
+    if total_non_vaccinated:
+        st.plotly_chart(px.pie(status_counts(ethnicity_counts, "ETHNICITY", "Non-Vaccinated Count"), names="ETHNICITY", values="count", title="Non-Vaccinated by Ethnicity"))
     else:
         st.info("No non-vaccinated data available.")
 
@@ -265,117 +683,72 @@ with col2:
 col3, col4 = st.columns(2)
 with col3:
     st.write("#### ✅ Vaccinated - Gender")
-    if not vaccinated_df.empty:
-        st.plotly_chart(px.pie(vaccinated_df, names="GENDER", title="Vaccinated by Gender"))
+    if total_vaccinated:
+        st.plotly_chart(px.pie(status_counts(gender_counts, "GENDER", "Vaccinated Count"), names="GENDER", values="count", title="Vaccinated by Gender"))
 
 with col4:
     st.write("#### ❌ Non-Vaccinated - Gender")
-    if not non_vaccinated_df.empty:
-        st.plotly_chart(px.pie(non_vaccinated_df, names="GENDER", title="Non-Vaccinated by Gender"))
+    if total_non_vaccinated:
+        st.plotly_chart(px.pie(status_counts(gender_counts, "GENDER", "Non-Vaccinated Count"), names="GENDER", values="count", title="Non-Vaccinated by Gender"))
 
 # Bar Charts by Age Group
 col5, col6 = st.columns(2)
 with col5:
     st.write("#### ✅ Vaccinated - Age Group")
-    if not vaccinated_df.empty:
-        st.plotly_chart(px.bar(vaccinated_df, x="AGE_GROUP", title="Vaccinated by Age Group"))
+    if total_vaccinated:
+        st.plotly_chart(px.bar(status_counts(age_group_counts, "AGE_GROUP", "Vaccinated Count"), x="AGE_GROUP", y="count", title="Vaccinated by Age Group"))
 
 with col6:
     st.write("#### ❌ Non-Vaccinated - Age Group")
-    if not non_vaccinated_df.empty:
-        st.plotly_chart(px.bar(non_vaccinated_df, x="AGE_GROUP", title="Non-Vaccinated by Age Group"))
-
-# ----------------- RACE MAPPING -----------------
-race_mapping = {
-    "Hispanic or Latino": "Hispanic",
-    "Not Hispanic or Latino": "White",
-    "African American": "Black",
-    "Asian": "Asian",
-    "Native American": "Native American",
-    "Pacific Islander": "Pacific Islander",
-    "Other": "Other"
-}
-
-for df_chunk in [vaccinated_df, non_vaccinated_df, filtered_df]:
-    if "RACE" not in df_chunk.columns:
-        df_chunk["RACE"] = df_chunk["ETHNICITY"].map(race_mapping).fillna("Unknown")
+    if total_non_vaccinated:
+        st.plotly_chart(px.bar(status_counts(age_group_counts, "AGE_GROUP", "Non-Vaccinated Count"), x="AGE_GROUP", y="count", title="Non-Vaccinated by Age Group"))
 
 # ----------------- BAR CHARTS BY RACE -----------------
 st.write("### 🧬 Vaccination by Race")
 
-if not vaccinated_df.empty:
-    st.plotly_chart(px.bar(vaccinated_df, x="RACE", title="Vaccinated by Race", color="RACE"))
+if total_vaccinated:
+    st.plotly_chart(px.bar(status_counts(race_summary, "RACE", "Vaccinated Count"), x="RACE", y="count", title="Vaccinated by Race", color="RACE"))
 else:
     st.info("No vaccinated data available.")
 
-if not non_vaccinated_df.empty:
-    st.plotly_chart(px.bar(non_vaccinated_df, x="RACE", title="Non-Vaccinated by Race", color="RACE"))
+if total_non_vaccinated:
+    st.plotly_chart(px.bar(status_counts(race_summary, "RACE", "Non-Vaccinated Count"), x="RACE", y="count", title="Non-Vaccinated by Race", color="RACE"))
 else:
     st.info("No non-vaccinated data available.")
 
 # ----------------- RACE-BASED SUMMARY TABLE -----------------
 st.write("### 🧾 Vaccination Breakdown by Race")
 
-v_race_summary = vaccinated_df.groupby("RACE").size().reset_index(name="Vaccinated Count")
-nv_race_summary = non_vaccinated_df.groupby("RACE").size().reset_index(name="Non-Vaccinated Count")
-
-race_summary = pd.merge(v_race_summary, nv_race_summary, on="RACE", how="outer").fillna(0)
-race_summary.loc[len(race_summary)] = ["Total", race_summary["Vaccinated Count"].sum(), race_summary["Non-Vaccinated Count"].sum()]
+race_summary.loc[len(race_summary)] = ["Total", total_vaccinated, total_non_vaccinated]
 st.dataframe(race_summary)
 
 # ----------------- ETHNICITY-GENDER-AGE SUMMARY -----------------
 st.write("### 📊 Summary: Ethnicity, Gender, Age Group")
 
-v_summary = vaccinated_df.groupby(["ETHNICITY", "GENDER", "AGE_GROUP"]).size().reset_index(name="Vaccinated Count")
-nv_summary = non_vaccinated_df.groupby(["ETHNICITY", "GENDER", "AGE_GROUP"]).size().reset_index(name="Non-Vaccinated Count")
-
-final_summary = pd.merge(v_summary, nv_summary, on=["ETHNICITY", "GENDER", "AGE_GROUP"], how="outer").fillna(0)
+final_summary = load_group_counts(("ETHNICITY", "GENDER", "AGE_GROUP"), state, city, vaccine_key)
 final_summary.loc[len(final_summary)] = ["Total", "Total", "Total",
-                                         v_summary["Vaccinated Count"].sum(),
-                                         nv_summary["Non-Vaccinated Count"].sum()]
+                                         final_summary["Vaccinated Count"].sum(),
+                                         final_summary["Non-Vaccinated Count"].sum()]
 
 st.dataframe(final_summary)
 
 
+# ----------------- FORECASTS (ON DEMAND) -----------------
+# The ARIMA fits and Census download below are the heaviest part of a rerun, only run them when asked
+if not st.sidebar.toggle("🔮 Show forecasts & Census comparison", value=False):
+    st.info("Turn on “🔮 Show forecasts & Census comparison” in the sidebar to load the forecast section.")
+    st.stop()
 
-
-
-
-
-
-import pandas as pd
-import numpy as np
-import requests
-from io import BytesIO
-from statsmodels.tsa.arima.model import ARIMA
-from sklearn.metrics import mean_absolute_error, mean_squared_error
-import plotly.express as px
-import plotly.graph_objects as go
-import streamlit as st
-
-# ----------------- URLs from Google Drive -----------------
-synthea_url = "https://docs.google.com/spreadsheets/d/1hJEb7aMjrD-EfAoN9jdhwBK2m9o0U-mh/export?format=xlsx"
-census_url = "https://drive.google.com/uc?id=1Fswh6Eq_wrsf5FbpaaUve9K0KOZ6q3zg"
-
-# ----------------- Load Synthea Excel -----------------
+# ----------------- Synthea Forecast -----------------
 st.write("### 🔮 Vaccination Forecast (Synthea Dataset)")
 
 synthea_loaded = False
 try:
-    response = requests.get(synthea_url)
-    excel_data = BytesIO(response.content)
-
-    full_df = pd.read_excel(excel_data, engine="openpyxl", sheet_name="not_vaccinated_analysis (3)", usecols=["YEAR", "VACCINATED"])
-    full_df["VACCINATED"] = full_df["VACCINATED"].astype(str).str.lower().map({"true": 1, "false": 0})
-    vaccinated_full = full_df[full_df["VACCINATED"] == 1]
-
-    yearly_vax = vaccinated_full.groupby("YEAR").size().reset_index(name="vaccinated_count")
-    model = ARIMA(yearly_vax["vaccinated_count"], order=(1, 1, 1))
-    model_fit = model.fit()
+    yearly_vax = load_yearly_vax()
 
     year_max = int(yearly_vax["YEAR"].max())
     future_years = list(range(year_max + 1, year_max + 6))
-    forecast = model_fit.forecast(steps=5)
+    forecast = arima_forecast(tuple(yearly_vax["vaccinated_count"]), steps=5)
 
     forecast_df = pd.DataFrame({"YEAR": future_years, "vaccinated_count": forecast})
     combined_df = pd.concat([yearly_vax, forecast_df], ignore_index=True)
@@ -389,28 +762,13 @@ except Exception as e:
     st.error(f"❌ Failed to load or forecast Synthea data: {e}")
 
 # ----------------- Load Census CSV -----------------
-import streamlit as st
-import pandas as pd
-import numpy as np
-import requests
-from io import BytesIO
-import plotly.express as px
-
 st.write("### 📡 Census vs Synthea Vaccination Comparison")
 
-# Your known Synthea vaccinated count
-total_vaccinated = 3728  # Replace this with your dynamic value if needed
-
-# Optional: estimated population if needed for later percentage comparisons
-# total_population_estimate = 13802
-
 real_total_vaccinated = 0
-census_url = "YOUR_CENSUS_DATA_URL.csv"  # Replace with your actual URL
 
 try:
     # Load census CSV from URL
-    response = requests.get(census_url)
-    census_df = pd.read_csv(BytesIO(response.content))
+    census_df = pd.read_csv(BytesIO(fetch_content(census_url)))
 
     # Make sure required columns exist
     if "fully_vaccinated" in census_df.columns and "partially_vaccinated" in census_df.columns:
@@ -431,26 +789,8 @@ except Exception as e:
     census_df = pd.DataFrame()
     st.error(f"❌ Failed to load Census data: {e}")
 
-# Display metrics side-by-side
-col1, col2 = st.columns(2)
-with col1:
-    st.metric("✅ Synthea Vaccinated", f"{total_vaccinated:,}")
-with col2:
-    st.metric("📡 Census Vaccinated", f"{int(real_total_vaccinated):,}")
-
-# Bar chart comparison
-compare_vax_df = pd.DataFrame({
-    "Dataset": ["Synthea", "Census"],
-    "Vaccinated": [total_vaccinated, real_total_vaccinated]
-})
-
-fig = px.bar(compare_vax_df, x="Dataset", y="Vaccinated", title="Vaccinated Individuals Comparison")
-fig.update_layout(yaxis_title="Number of Vaccinated People")
-st.plotly_chart(fig)
-
-
 # ----------------- Metrics Display -----------------
-synthea_total = vaccinated_full.shape[0] if 'vaccinated_full' in locals() else 0
+synthea_total, synthea_unvax = load_status_totals()
 
 col1, col2 = st.columns(2)
 col1.metric("✅ Synthea Vaccinated", f"{synthea_total:,}")
@@ -471,7 +811,6 @@ else:
 # ----------------- Unvaccinated % Comparison -----------------
 st.write("### ❗ Unvaccinated Population Proportions")
 
-synthea_unvax = full_df[full_df["VACCINATED"] == 0].shape[0] if 'full_df' in locals() else 0
 synthea_total_pop = synthea_total + synthea_unvax
 synthea_unvax_pct = (synthea_unvax / synthea_total_pop) * 100 if synthea_total_pop > 0 else 0
 
@@ -490,14 +829,12 @@ col2.metric("🚫 Census Unvaccinated", f"{census_unvax_pct:.2f}%")
 if synthea_loaded:
     st.write("### 🧪 Forecast Validation (Train/Test Split)")
     try:
-        yearly_vax = vaccinated_full.groupby("YEAR").size().reset_index(name="vaccinated_count").sort_values("YEAR")
+        yearly_vax = load_yearly_vax()
         test_years = 5
         train_data = yearly_vax[:-test_years]
         test_data = yearly_vax[-test_years:]
 
-        model = ARIMA(train_data["vaccinated_count"], order=(1, 1, 1))
-        model_fit = model.fit()
-        forecast = model_fit.forecast(steps=test_years)
+        forecast = arima_forecast(tuple(train_data["vaccinated_count"]), steps=test_years)
 
         forecast_df = pd.DataFrame({
             "YEAR": test_data["YEAR"].values,